@@ -72,14 +72,16 @@ def get_inputs(params):
         with distal/proximal specificity for evoked,ongoing inputs
     """
 
-    dinty = {'evoked': usingEvokedInputs(params),
-             'ongoing': usingOngoingInputs(params),
-             'tonic': usingTonicInputs(params),
+    # each check scans the params, so the combined evoked and ongoing
+    # checks are derived from the proximal and distal ones
+    dinty = {'tonic': usingTonicInputs(params),
              'pois': usingPoissonInputs(params),
              'evdist': usingEvokedInputs(params, lsuffty=['_evdist_']),
              'evprox': usingEvokedInputs(params, lsuffty=['_evprox_']),
              'dist': usingOngoingInputs(params, lty=['_dist']),
              'prox': usingOngoingInputs(params, lty=['_prox'])}
+    dinty['evoked'] = dinty['evprox'] or dinty['evdist']
+    dinty['ongoing'] = dinty['prox'] or dinty['dist']
 
     return dinty
 
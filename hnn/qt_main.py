@@ -1012,7 +1012,12 @@ class HNNGUI(QMainWindow):
         sim_data['spec'] = []
         params = result.params
 
-        sim_data['dpls'] = deepcopy(sim_data['raw_dpls'])
+        if params['save_dpl']:
+            # keep the unprocessed dipoles for writing to disk below
+            sim_data['dpls'] = deepcopy(sim_data['raw_dpls'])
+        else:
+            # smooth and scale in place, raw dipoles aren't used again
+            sim_data['dpls'] = sim_data['raw_dpls']
         ntrial = len(sim_data['raw_dpls'])
         for trial_idx in range(ntrial):
             window_len = params['dipole_smooth_win']  # specified in ms
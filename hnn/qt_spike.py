@@ -13,10 +13,9 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
+from matplotlib.colors import to_rgb
 import matplotlib.gridspec as gridspec
 
-from pylab import convolve
-
 from .DataViewGUI import DataViewGUI
 from .paramrw import usingEvokedInputs, usingOngoingInputs, usingPoissonInputs
 from .spikefn import ExtInputs
@@ -33,68 +32,103 @@ dclr = {'L2_pyramidal': 'g',
         'L5_pyramidal': 'r',
         'L2_basket': 'w',
         'L5_basket': 'b'}
+# RGB values of dclr in the same order, for indexing by cell type position
+dclr_rgb = np.array([to_rgb(clr) for clr in dclr.values()])
+# RGB values of proximal, distal and other input spikes
+input_rgb = np.array([to_rgb(clr) for clr in ('r', 'g', 'orange')])
 
 
 # convolve with a hamming window
 def hammfilt(x, winsz):
     win = hamming(winsz)
     win /= sum(win)
-    return convolve(x, win, 'same')
+    return np.convolve(x, win, 'same')
 
 
 # adjust input gids for display purposes
-def adjustinputgid(extinputs, gid):
-    if gid == extinputs.gid_prox:
-        return 0
-    elif gid == extinputs.gid_dist:
-        return 1
-    elif extinputs.is_prox_gid(gid):
-        return 2
-    elif extinputs.is_dist_gid(gid):
-        return 3
-    return gid
-
-
-def gid_to_type(extinputs, gid):
-    for gidtype, gids in extinputs.gid_ranges.items():
-        if gid in gids:
-            return gidtype
-
-
-def getdspk(spikes, extinputs, tstop):
-    ddat = {}
-    ddat['spk'] = spikes
-
-    dspk = {'Cell': ([], [], []),
-            'Input': ([], [], [])}
+def adjustinputgid(extinputs, gids, is_prox, is_dist):
+    return np.select([gids == extinputs.gid_prox,
+                      gids == extinputs.gid_dist,
+                      is_prox, is_dist],
+                     [0, 1, 2, 3], gids)
+
+
+def get_gid_luts(extinputs):
+    """Get lookup arrays indexed by gid
+
+    Returns
+    -------
+    type_lut : array of int
+        Position in dclr of the cell type of each gid, -1 for inputs
+    prox_lut : array of bool
+        Whether each gid is associated with a proximal input
+    dist_lut : array of bool
+        Whether each gid is associated with a distal input
+    """
+    n_gids = max(max(gids) + 1 for gids in extinputs.gid_ranges.values()
+                 if len(gids) > 0)
+    type_lut = np.full(n_gids, -1)
+    for type_idx, ty in enumerate(dclr):
+        type_lut[np.asarray(extinputs.gid_ranges[ty], dtype=int)] = type_idx
+
+    all_gids = np.arange(n_gids)
+    prox_lut = extinputs.is_prox_gid(all_gids)
+    dist_lut = extinputs.is_dist_gid(all_gids)
+
+    return type_lut, prox_lut, dist_lut
+
+
+def get_hist_bins(tstop):
+    """Get the edges and centers of the cell spike histogram bins"""
+    nbins = ceil(tstop / binsz)
+    bin_edges = np.linspace(0, tstop, nbins + 1)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    return bin_edges, bin_centers
+
+
+def getdspk(spikes, extinputs, bin_edges):
+    spike_times = spikes[:, 0]
+    spike_gids = spikes[:, 1]
+
+    type_lut, prox_lut, dist_lut = get_gid_luts(extinputs)
+    spike_types = type_lut[spike_gids.astype(int)]
+
+    is_cell = spike_types >= 0
+
+    # count the spikes of all cell types per bin in a single pass. Bins
+    # are the same as np.histogram(times, bins=nbins, range=(0, tstop))
+    nbins = len(bin_edges) - 1
+    tstop = bin_edges[-1]
+    in_range = is_cell & (spike_times >= 0) & (spike_times <= tstop)
+    bin_idx = np.searchsorted(bin_edges, spike_times[in_range], side='right')
+    bin_idx = np.minimum(bin_idx - 1, nbins - 1)
+    counts = np.bincount(spike_types[in_range] * nbins + bin_idx,
+                         minlength=len(dclr) * nbins)
+    counts = counts.reshape(len(dclr), nbins)
+
     dhist = {}
-    for ty in dclr.keys():
-        dhist[ty] = []
-    haveinputs = False
-    for (t, gid) in ddat['spk']:
-        ty = gid_to_type(extinputs, gid)
-        if ty in dclr:
-            dspk['Cell'][0].append(t)
-            dspk['Cell'][1].append(gid)
-            dspk['Cell'][2].append(dclr[ty])
-            dhist[ty].append(t)
-        else:
-            dspk['Input'][0].append(t)
-            dspk['Input'][1].append(adjustinputgid(extinputs, gid))
-            if extinputs.is_prox_gid(gid):
-                dspk['Input'][2].append('r')
-            elif extinputs.is_dist_gid(gid):
-                dspk['Input'][2].append('g')
-            else:
-                dspk['Input'][2].append('orange')
-            haveinputs = True
-    for ty in dhist.keys():
-        dhist[ty] = np.histogram(dhist[ty], range=(0, tstop),
-                                 bins=ceil(tstop / binsz))
+    for type_idx, ty in enumerate(dclr):
         if smoothsz > 0:
-            dhist[ty] = hammfilt(dhist[ty][0], smoothsz)
+            dhist[ty] = hammfilt(counts[type_idx], smoothsz)
         else:
-            dhist[ty] = dhist[ty][0]
+            dhist[ty] = counts[type_idx]
+
+    # all other spikes are from inputs
+    is_input = ~is_cell
+    input_gids = spike_gids[is_input]
+    input_gid_idx = input_gids.astype(int)
+    is_prox = prox_lut[input_gid_idx]
+    is_dist = dist_lut[input_gid_idx]
+    input_colors = input_rgb[np.select([is_prox, is_dist], [0, 1], 2)]
+    dspk = {'Cell': {'times': spike_times[is_cell],
+                     'gids': spike_gids[is_cell],
+                     'colors': dclr_rgb[spike_types[is_cell]]},
+            'Input': {'times': spike_times[is_input],
+                      'gids': adjustinputgid(extinputs, input_gids, is_prox,
+                                             is_dist),
+                      'colors': input_colors}}
+    haveinputs = bool(is_input.any())
+
     return dspk, haveinputs, dhist
 
 
@@ -115,10 +149,17 @@ class SpikeCanvas(FigureCanvasQTAgg):
         self.G = gridspec.GridSpec(16, 1)
 
         self.sim_data = sim_data
-        self.alldat = {}
+        # data already loaded for each index are kept by the viewer window,
+        # since it creates a new canvas whenever the view changes
+        if parent is not None:
+            self.alldat = parent.alldat
+        else:
+            self.alldat = {}
 
         # whether to draw histograms (spike counts per time)
         self.bDrawHist = True
+        # histogram bins depend only on tstop
+        self.bin_edges, self.bin_centers = get_hist_bins(params['tstop'])
 
         self.plot()
 
@@ -135,8 +176,11 @@ class SpikeCanvas(FigureCanvasQTAgg):
         if ntrial > 0:
             fctr = 1.0 / ntrial
         for ty in dhist.keys():
-            ax.plot(np.arange(binsz / 2, tstop + binsz / 2, binsz),
-                    dhist[ty] * fctr, dclr[ty], linestyle='--')
+            if not dhist[ty].any():
+                # no spikes from this cell type
+                continue
+            ax.plot(self.bin_centers, dhist[ty] * fctr, dclr[ty],
+                    linestyle='--')
         ax.set_xlim((0, tstop))
         ax.set_ylabel('Cell Spikes')
         return ax
@@ -219,7 +263,8 @@ class SpikeCanvas(FigureCanvasQTAgg):
                 random_label += 1
                 lax.append(ax)
 
-                ax.scatter(dspk[k][0], dspk[k][1], c=dspk[k][2], s=sz**2)
+                ax.scatter(dspk[k]['times'], dspk[k]['gids'],
+                           c=dspk[k]['colors'], s=sz**2)
                 ax.set_ylabel(k + ' ID')
                 white_patch = mpatches.Patch(color='white',
                                              label='L2/3 Basket')
@@ -236,28 +281,33 @@ class SpikeCanvas(FigureCanvasQTAgg):
     def loadspk(self, idx):
         if idx in self.alldat:
             return
-        self.alldat[idx] = {}
 
-        trials = [trial_idx for trial_idx in range(self.params['N_trials'])]
-        self.extinputs = ExtInputs(self.sim_data['spikes'],
-                                   self.sim_data['gid_ranges'],
-                                   trials, self.params)
+        if len(self.alldat) > 0:
+            # input spikes from all trials are used for every index
+            self.extinputs = next(iter(self.alldat.values()))['extinputs']
+        else:
+            trials = [trial_idx for trial_idx in
+                      range(self.params['N_trials'])]
+            self.extinputs = ExtInputs(self.sim_data['spikes'],
+                                       self.sim_data['gid_ranges'],
+                                       trials, self.params)
+        self.alldat[idx] = {}
 
         if idx == 0 and self.params['N_trials'] > 1:
-            # combine spikes into a single list for all trials
-            spike_times = np.array(sum(self.sim_data['spikes'].spike_times,
-                                       []))
-            spike_gids = np.array(sum(self.sim_data['spikes'].spike_gids, []))
+            # combine spikes into a single array for all trials
+            spike_times = np.concatenate(
+                self.sim_data['spikes'].spike_times).astype(np.float64)
+            spike_gids = np.concatenate(
+                self.sim_data['spikes'].spike_gids).astype(np.float64)
         else:
             spike_times = self.sim_data['spikes'].spike_times[idx - 1]
             spike_gids = self.sim_data['spikes'].spike_gids[idx - 1]
 
-        empty_array = np.empty((len(spike_times), 0), np.float64)
-        spike_arr = np.array([spike_times, spike_gids])
-        spike_arr = np.append(empty_array, spike_arr.transpose(), axis=1)
+        spike_arr = np.column_stack((np.asarray(spike_times, np.float64),
+                                     np.asarray(spike_gids, np.float64)))
 
         dspk, haveinputs, dhist = getdspk(spike_arr, self.extinputs,
-                                          self.params['tstop'])
+                                          self.bin_edges)
         self.alldat[idx]['dspk'] = dspk
         self.alldat[idx]['haveinputs'] = haveinputs
         self.alldat[idx]['dhist'] = dhist
@@ -303,6 +353,8 @@ class SpikeViewGUI(DataViewGUI):
     Required parameters: tstop, N_trials
     """
     def __init__(self, CanvasType, params, sim_data, title):
+        # spike data loaded by the canvas for each index
+        self.alldat = {}
         super(SpikeViewGUI, self).__init__(CanvasType, params, sim_data, title)
         self.addViewHistAction()
 
@@ -6,20 +6,35 @@
 
 import os
 import sys
-from math import ceil, isclose
+import signal
+import multiprocessing
+from math import isclose
 from contextlib import redirect_stdout
 import traceback
 from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from threading import Event, Lock
 import numpy as np
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import nlopt
+from psutil import cpu_count, Process, NoSuchProcess
 from PyQt5 import QtCore
 from hnn_core import simulate_dipole, Network, MPIBackend
 
 from .paramrw import get_output_dir, hnn_core_compat_params
 
+# maximum number of weighted RMSE values remembered during optimization
+_werr_cache_size = 1024
+
+# relative change in weighted RMSE below which an optimization step stops
+_opt_ftol_rel = 1e-3
+
+# limit threaded math libraries to one thread in each MPI rank
+_single_thread_env = {'OMP_NUM_THREADS': '1',
+                      'OPENBLAS_NUM_THREADS': '1',
+                      'MKL_NUM_THREADS': '1'}
+
 
 class BasicSignal(QtCore.QObject):
     """for signaling"""
@@ -31,19 +46,22 @@ class ObjectSignal(QtCore.QObject):
     sig = QtCore.pyqtSignal(object)
 
 
-class QueueSignal(QtCore.QObject):
-    """for returning data"""
-    qsig = QtCore.pyqtSignal(Queue, str, float)
-
-
 class QueueDataSignal(QtCore.QObject):
     """for returning data"""
     qsig = QtCore.pyqtSignal(Queue, str, np.ndarray, float, float)
 
 
-class EventSignal(QtCore.QObject):
-    """for synchronization"""
-    esig = QtCore.pyqtSignal(Event, str)
+class SyncSignal(QtCore.QObject):
+    """for waiting until earlier signals have been handled"""
+    esig = QtCore.pyqtSignal(Event)
+
+    def __init__(self):
+        super().__init__()
+        # slot runs in the thread this object was created in
+        self.esig.connect(self._set_event)
+
+    def _set_event(self, event):
+        event.set()
 
 
 class TextSignal(QtCore.QObject):
@@ -115,6 +133,174 @@ def simulate(net):
     return sim_data
 
 
+class MPISimulator(object):
+    """Run simulations over an MPIBackend that is held open between calls
+
+    Optimization runs many short simulations back to back. Reusing one
+    simulator avoids constructing a new SimThread and its signals for every
+    evaluation of the objective. Note that hnn-core still launches mpiexec
+    for every simulation.
+
+    Parameters
+    ----------
+    ncore : int
+        Number of cores to run simulations over. Limited to the number of
+        physical cores, since hyperthreads sharing a core compete for the
+        same floating point units.
+    bind_to_core : bool
+        Whether to pin each MPI rank to a core (Linux only). Should be False
+        when several simulators run at the same time, otherwise they would
+        all be pinned to the same cores.
+
+    Attributes
+    ----------
+    ncore : int
+        Number of cores to run simulations over
+    mpi_cmd : str
+        The mpi launcher command (with options) passed to MPIBackend
+    backend : MPIBackend | None
+        The hnn-core backend responsible for running simulations. None when
+        outside of the context manager.
+    """
+
+    def __init__(self, ncore, bind_to_core=True):
+        n_physical_cores = cpu_count(logical=False)
+        if n_physical_cores is not None:
+            ncore = min(ncore, n_physical_cores)
+        self.ncore = ncore
+
+        self.mpi_cmd = 'mpiexec'
+        if bind_to_core and sys.platform.startswith('linux'):
+            self.mpi_cmd += ' --bind-to core --map-by core'
+
+        self.backend = None
+        self._old_env = {}
+
+    def __enter__(self):
+        # the backend is entered first, so that the environment isn't left
+        # modified if this raises
+        self.backend = MPIBackend(n_procs=self.ncore, mpi_cmd=self.mpi_cmd)
+        self.backend.__enter__()
+
+        # MPIBackend copies os.environ for the mpiexec process when each
+        # simulation starts. Note that this changes the environment of the
+        # whole GUI process (for OptThread, from its worker thread and for
+        # the entire optimization) until __exit__ restores it.
+        self._old_env = {var: os.environ.get(var)
+                         for var in _single_thread_env}
+        os.environ.update(_single_thread_env)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.backend.__exit__(type, value, traceback)
+        self.backend = None
+
+        for var, val in self._old_env.items():
+            if val is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = val
+
+    def run(self, params, tstop=None):
+        """Simulate the network described by params
+
+        Parameters
+        ----------
+        params : dict
+            Dictionary of params describing simulation config
+        tstop : float | None
+            Optional to limit the stopping point of the simulation. If None,
+            the entire simulation length will be run until 'tstop'
+
+        Returns
+        ----------
+        sim_data : dict
+            The simulation results returned by simulate()
+        """
+
+        sim_params = hnn_core_compat_params(params)
+        if tstop is not None:
+            sim_params['tstop'] = round(tstop, 8)
+
+        # create the network from the parameter file
+        # Note: NEURON objects haven't been created yet
+        net = Network(sim_params, add_drives_from_params=True)
+        return simulate(net)
+
+    def use_single_core(self):
+        """Run the following simulations on a single core without mpiexec
+
+        Must be called inside of the context manager.
+        """
+        self.backend.__exit__(None, None, None)
+        self.ncore = 1
+        self.backend = MPIBackend(n_procs=self.ncore, mpi_cmd=self.mpi_cmd)
+        self.backend.__enter__()
+
+    def terminate(self):
+        """Terminate the running simulation, if any"""
+        if self.backend is not None:
+            self.backend.terminate()
+
+
+def _get_opt_algorithm(num_params, num_sims):
+    """Choose the local optimization algorithm for an optimization step
+
+    BOBYQA builds a quadratic model of the weighted RMSE and usually needs
+    fewer simulations than COBYLA, but it first spends 2 * num_params + 1
+    simulations on points that don't depend on each other's fits. It is
+    only used when num_sims leaves at least num_params simulations after
+    those.
+
+    Parameters
+    ----------
+    num_params : int
+        Number of parameters optimized in the step
+    num_sims : int
+        Maximum number of simulations in the step
+
+    Returns
+    -------
+    algorithm : int
+        The nlopt algorithm
+    """
+    if num_sims >= 3 * num_params + 1:
+        return nlopt.LN_BOBYQA
+    return nlopt.LN_COBYLA
+
+
+def _init_presimulate(worker_pids):
+    """Report the pid of a worker process for OptThread pre-sampling
+
+    On POSIX, the worker also starts a new session, so that it leads a
+    process group shared with the mpiexec and nrniv processes it launches.
+    """
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    worker_pids.put(os.getpid())
+
+
+def _terminate_presimulate(pid):
+    """Terminate a pre-sampling worker and the processes it launched"""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(pid, signal.SIGTERM)
+        else:
+            process = Process(pid)
+            for child in process.children(recursive=True):
+                child.terminate()
+            process.terminate()
+    except (ProcessLookupError, NoSuchProcess):
+        pass  # already finished
+
+
+def _presimulate(params, ncore, tstop):
+    """Run a simulation in a worker process for OptThread pre-sampling"""
+    # several of these run at once, so don't pin them to the same cores
+    with MPISimulator(ncore, bind_to_core=False) as simulator:
+        return simulator.run(params, tstop=tstop)
+
+
 # based on https://nikolak.com/pyqt-threading-tutorial/
 class SimThread(QtCore.QThread):
     """The SimThread class.
@@ -247,12 +433,10 @@ class SimThread(QtCore.QThread):
         with self.killed_lock:
             self.killed = False
 
-        # make copy of params dict in Params object before
-        # modifying tstop
-        sim_params = hnn_core_compat_params(self.params)
-        if sim_length is not None:
-            sim_params['tstop'] = round(sim_length, 8)
-
+        # MPISimulator already limits ncore to the physical cores available,
+        # so launching fewer MPI ranks will not fix a failed start. Instead
+        # of repeatedly halving ncore, only retry once on a single core,
+        # which runs the simulation without mpiexec.
         while True:
             if self.ncore == 0:
                 raise RuntimeError("No cores available for simulation")
@@ -260,16 +444,13 @@ class SimThread(QtCore.QThread):
             try:
                 sim_log = self._log_sim_status(parent=self)
                 with redirect_stdout(sim_log):
-                    # create the network from the parameter file
-                    # Note: NEURON objects haven't been created yet
-                    net = Network(sim_params, add_drives_from_params=True)
-                    with MPIBackend(
-                            n_procs=self.ncore, mpi_cmd='mpiexec') as backend:
-                        self.backend = backend
+                    with MPISimulator(self.ncore) as simulator:
+                        self.backend = simulator.backend
                         with self.killed_lock:
                             if self.killed:
                                 raise RuntimeError("Terminated")
-                        sim_data = simulate(net)
+                        sim_data = simulator.run(self.params,
+                                                 tstop=sim_length)
                     self.backend = None
                 break
             except RuntimeError as e:
@@ -279,14 +460,13 @@ class SimThread(QtCore.QThread):
                     self._updatewaitsimwin(str(e))
                     raise RuntimeError("Simulation failed to start")
 
-            # check if proc was killed before retrying with fewer cores
+            # check if proc was killed before retrying with 1 core
             with self.killed_lock:
                 if self.killed:
                     raise RuntimeError("Terminated")
 
-            self.ncore = ceil(self.ncore / 2)
-            txt = "INFO: Failed starting simulation, retrying with %d cores" \
-                % self.ncore
+            self.ncore = 1
+            txt = "INFO: Failed starting simulation, retrying with 1 core"
             print(txt)
             self._updatewaitsimwin(txt)
 
@@ -310,9 +490,15 @@ class OptThread(SimThread):
         'prng_seedcore_opt', but it is not read from the parameter file by
         hnn-core
     sim_data : SimData object
-        Reference to the class containing simulation data. Only used for
-        references to functions for emitting signals. The one exception is
-        using the SimData.in_sim_data member function
+        Reference to the class containing simulation data. Results are
+        stored and the weighted RMSE is calculated in the GUI thread, through
+        queued signals. The in_sim_data, get_err,
+        update_opt_data_from_sim_data, update_initial_opt_data_from_sim_data
+        and update_sim_data_from_opt_data member functions are called
+        directly from this thread. Their access to the optimization data is
+        protected by SimData._opt_data_lock, and get_err's access to the
+        experimental data by SimData._exp_data_lock. sim_data[paramfn] is
+        read and written without a lock (see _run).
     result_callback: function
         Handle to for callback to call after every sim completion
     mainwin : HNNGUI
@@ -337,9 +523,15 @@ class OptThread(SimThread):
     step_sims : int
         Number of sim in this step
     sim_data : SimData object
-        Reference to the class containing simulation data. Only used for
-        references to functions for emitting signals. The one exception is
-        using the SimData.in_sim_data member function
+        Reference to the class containing simulation data. Results are
+        stored and the weighted RMSE is calculated in the GUI thread, through
+        queued signals. The in_sim_data, get_err,
+        update_opt_data_from_sim_data, update_initial_opt_data_from_sim_data
+        and update_sim_data_from_opt_data member functions are called
+        directly from this thread. Their access to the optimization data is
+        protected by SimData._opt_data_lock, and get_err's access to the
+        experimental data by SimData._exp_data_lock. sim_data[paramfn] is
+        read and written without a lock (see _run).
     result_callback: function
         Handle for callback to call after every sim completion
     seed : seed for optimization set in the GUI. The parameter for this is
@@ -352,10 +544,13 @@ class OptThread(SimThread):
     paramfn : str
         The parameter file name (full path) to simulate
     sim_thread : SimThread object
-        The thread running a simulation. Used for running optimization
-        iterations and initial or final simulations, if necessary.
+        The thread running a simulation. Used for running initial or final
+        simulations, if necessary.
     sim_running : bool
         Whether a current simulation is running at sim_thread handle
+    mpi_sim : MPISimulator | None
+        The simulator reused by every optimization iteration. Only set while
+        the optimization is running.
     opt_start : float
         Time in ms to begin optimization over the dipole waveform in this
         step. Used for weighted RMSE calculation, but not for running
@@ -365,6 +560,13 @@ class OptThread(SimThread):
     opt : nlopt.opt object
     opt_weights : np.ndarray
         Array containing the weights used for RMSE calculation for this step
+    opt_param_names : list of str
+        Names of the parameters being optimized in this step, in the order
+        used by nlopt
+    opt_lb : np.ndarray
+        Lower bounds of the parameters being optimized in this step
+    opt_ub : np.ndarray
+        Upper bounds of the parameters being optimized in this step
     killed : bool
         Whether this simulation was forcefully terminated. Will not continue
         relaunching simulations if True
@@ -373,19 +575,26 @@ class OptThread(SimThread):
         opt_callback param to this function
     refresh_signal : BasicSignal object
         Signal to be emitted for refreshing the plots in the main GUI
-    update_sim_data_from_opt_data : EventSignal object
-        Signal to be emitted for updating sim_data[paramfn] with the
-        contents of opt_data
-    update_opt_data_from_sim_data : EventSignal object
-        Signal to be emitted for updating opt_data with the
-        contents of sim_data[paramfn]
-    update_initial_opt_data_from_sim_data : EventSignal object
-        Signal to be emitted for updating opt_data with initial dipole
-        and initial error using the contents of sim_data[paramfn]
-    get_err_from_sim_data : QueueSignal object
-        Signal to be emitted to request the regular RMSE be put in the queue
+    sync_signal : SyncSignal object
+        Signal to be emitted for waiting until the GUI thread has stored
+        the results of earlier simulations in sim_data
     get_werr_from_sim_data : QueueDataSignal object
         Signal to be emitted to request the weighted RMSE be put in the queue
+    err_queue : Queue
+        Queue reused by every iteration for receiving the weighted RMSE
+    werr_cache : OrderedDict
+        Weighted RMSE of parameter sets already simulated, keyed by the
+        optimization step and the rounded parameter values. Used to skip
+        simulating the same parameters twice.
+    presim_results : dict
+        Simulation results computed ahead of time for the first parameter
+        sets of a step, keyed like werr_cache
+    presim_futures : list of Future
+        The simulations computing presim_results. Only set while they are
+        running so that they can be cancelled.
+    presim_worker_pids : multiprocessing.SimpleQueue | None
+        Receives the pids of the worker processes running presim_futures,
+        which are terminated when the optimization is stopped
     """
     def __init__(self, ncore, params, num_steps, seed, sim_data,
                  result_callback, opt_callback, mainwin):
@@ -404,10 +613,14 @@ class OptThread(SimThread):
         self.initial_err = sys.float_info.max
         self.sim_thread = None
         self.sim_running = False
+        self.mpi_sim = None
         self.opt_start = 0.0
         self.opt_end = 0.0
         self.opt = None
         self.opt_weights = None
+        self.opt_param_names = []
+        self.opt_lb = None
+        self.opt_ub = None
         self.killed = False
 
         self.done_signal.tsig.connect(opt_callback)
@@ -415,23 +628,15 @@ class OptThread(SimThread):
         self.refresh_signal = BasicSignal()
         self.refresh_signal.sig.connect(self.mainwin.initSimCanvas)
 
-        self.update_sim_data_from_opt_data = EventSignal()
-        self.update_sim_data_from_opt_data.esig.connect(
-            sim_data.update_sim_data_from_opt_data)
-
-        self.update_opt_data_from_sim_data = EventSignal()
-        self.update_opt_data_from_sim_data.esig.connect(
-            sim_data.update_opt_data_from_sim_data)
-
-        self.update_initial_opt_data_from_sim_data = EventSignal()
-        self.update_initial_opt_data_from_sim_data.esig.connect(
-            sim_data.update_initial_opt_data_from_sim_data)
-
-        self.get_err_from_sim_data = QueueSignal()
-        self.get_err_from_sim_data.qsig.connect(sim_data.get_err_wrapper)
+        self.sync_signal = SyncSignal()
 
         self.get_werr_from_sim_data = QueueDataSignal()
         self.get_werr_from_sim_data.qsig.connect(sim_data.get_werr_wrapper)
+        self.err_queue = Queue()
+        self.werr_cache = OrderedDict()
+        self.presim_results = {}
+        self.presim_futures = []
+        self.presim_worker_pids = None
 
     def run(self):
         msg = ''
@@ -442,7 +647,13 @@ class OptThread(SimThread):
         """Terminate running simulation"""
         with self.killed_lock:
             self.killed = True
-            self.sim_thread.stop()
+            for future in self.presim_futures:
+                future.cancel()
+            self._terminate_presim_workers()
+            if self.mpi_sim is not None:
+                self.mpi_sim.terminate()
+            if self.sim_thread is not None:
+                self.sim_thread.stop()
 
         self.done_signal.tsig.emit("Optimization terminated")
 
@@ -451,6 +662,53 @@ class OptThread(SimThread):
         nlopt.srand(self.seed)
         self._get_initial_data()
 
+        # every optimization iteration reuses the same simulator
+        try:
+            with MPISimulator(self.ncore) as self.mpi_sim:
+                self._run_opt_steps()
+        finally:
+            # also when terminated, don't keep the exited simulator
+            self.mpi_sim = None
+
+        # update sim_data with the final best. sim_data[paramfn] is written
+        # here without a lock. This relies on the GUI thread having stored
+        # the last simulation already, which it has: _opt_sim waits for the
+        # queued weighted RMSE request that is emitted after each result.
+        self.sim_data.update_sim_data_from_opt_data(self.paramfn)
+        self.refresh_signal.sig.emit()  # redraw with updated RMSE
+
+        # check that optimization improved RMSE
+        final_err = self.sim_data.get_err(self.paramfn, self.params['tstop'])
+        print("Best RMSE: %f" % final_err)
+        if final_err > self.initial_err:
+            txt = "Warning: optimization failed to improve RMSE below" + \
+                  " %.2f. Reverting to old parameters." % \
+                        round(self.initial_err, 2)
+            self._updatewaitsimwin(txt)
+            print(txt)
+
+            initial_params = self.optparamwin.get_initial_params()
+            # populate param values into GUI and save params to file
+            self.baseparamwin.update_gui_params(initial_params)
+
+            # update optimization dialog window
+            self.optparamwin.push_chunk_ranges(initial_params)
+
+            # run a full length simulation
+            self.sim_thread = SimThread(self.ncore, self.params,
+                                        self.result_callback,
+                                        mainwin=self.mainwin)
+            self.sim_running = True
+            self.sim_thread.run()
+            self.sim_thread.wait()
+            with self.killed_lock:
+                if self.killed:
+                    self.quit()
+            self.sim_running = False
+
+    def _run_opt_steps(self):
+        """Run every optimization step using self.mpi_sim"""
+
         for step in range(self.num_steps):
             self.cur_step = step
             self.cur_itr = 0
@@ -474,15 +732,12 @@ class OptThread(SimThread):
                 self._updatewaitsimwin(txt)
                 continue
 
-            txt = "Starting optimization step %d/%d" % (step + 1,
-                                                        self.num_steps)
-            self._updatewaitsimwin(txt)
-            print(txt)
-
             self.opt_start = self.optparamwin.get_chunk_start(self.cur_step)
             self.opt_end = self.optparamwin.get_chunk_end(self.cur_step)
-            txt = 'Optimizing from [%3.3f-%3.3f] ms' % (self.opt_start,
-                                                        self.opt_end)
+            txt = "Starting optimization step %d/%d" % (step + 1,
+                                                        self.num_steps) + \
+                os.linesep + 'Optimizing from [%3.3f-%3.3f] ms' % \
+                (self.opt_start, self.opt_end)
             self._updatewaitsimwin(txt)
             print(txt)
 
@@ -491,8 +746,8 @@ class OptThread(SimThread):
                 self.optparamwin.get_chunk_weights(self.cur_step)
 
             # run an opt step
-            algorithm = nlopt.LN_COBYLA
             self.num_params = len(self.step_ranges)
+            algorithm = _get_opt_algorithm(self.num_params, self.step_sims)
             self.opt = nlopt.opt(algorithm, self.num_params)
             opt_results = self._run_opt_step(self.step_ranges, self.step_sims,
                                              algorithm)
@@ -518,45 +773,6 @@ class OptThread(SimThread):
             # update optimization dialog window
             self.optparamwin.push_chunk_ranges(push_values)
 
-        # update opt_data with the final best
-        update_event = Event()
-        self.update_sim_data_from_opt_data.esig.emit(update_event,
-                                                     self.paramfn)
-        update_event.wait()
-        self.refresh_signal.sig.emit()  # redraw with updated RMSE
-
-        # check that optimization improved RMSE
-        err_queue = Queue()
-        self.get_err_from_sim_data.qsig.emit(err_queue, self.paramfn,
-                                             self.params['tstop'])
-        final_err = err_queue.get()
-        print("Best RMSE: %f" % final_err)
-        if final_err > self.initial_err:
-            txt = "Warning: optimization failed to improve RMSE below" + \
-                  " %.2f. Reverting to old parameters." % \
-                        round(self.initial_err, 2)
-            self._updatewaitsimwin(txt)
-            print(txt)
-
-            initial_params = self.optparamwin.get_initial_params()
-            # populate param values into GUI and save params to file
-            self.baseparamwin.update_gui_params(initial_params)
-
-            # update optimization dialog window
-            self.optparamwin.push_chunk_ranges(initial_params)
-
-            # run a full length simulation
-            self.sim_thread = SimThread(self.ncore, self.params,
-                                        self.result_callback,
-                                        mainwin=self.mainwin)
-            self.sim_running = True
-            self.sim_thread.run()
-            self.sim_thread.wait()
-            with self.killed_lock:
-                if self.killed:
-                    self.quit()
-            self.sim_running = False
-
     def _get_initial_data(self):
         """Run an initial simulation if necessary"""
 
@@ -585,50 +801,58 @@ class OptThread(SimThread):
                     self.quit()
             self.sim_running = False
 
-            # results are in self.sim_data now
+            # the result callback stores the results in self.sim_data from
+            # the GUI thread. Wait until it has been handled.
+            sync_event = Event()
+            self.sync_signal.esig.emit(sync_event)
+            sync_event.wait()
 
         # store the initial fit for display in final dipole plot as
         # black dashed line.
-        update_event = Event()
-        self.update_opt_data_from_sim_data.esig.emit(update_event,
-                                                     self.paramfn)
-        update_event.wait()
-        update_event.clear()
-        self.update_initial_opt_data_from_sim_data.esig.emit(update_event,
-                                                             self.paramfn)
-        update_event.wait()
-
-        err_queue = Queue()
-        self.get_err_from_sim_data.qsig.emit(err_queue, self.paramfn,
-                                             self.params['tstop'])
-        self.initial_err = err_queue.get()
+        self.sim_data.update_opt_data_from_sim_data(self.paramfn)
+        self.sim_data.update_initial_opt_data_from_sim_data(self.paramfn)
+
+        self.initial_err = self.sim_data.get_err(self.paramfn,
+                                                 self.params['tstop'])
 
     def _opt_sim(self, new_params, grad=0):
-        """Run a SimThread simulation and calculate weighted RMSE
+        """Run a simulation with self.mpi_sim and calculate weighted RMSE
 
         Called by nlopt.opt routine
         """
+        with self.killed_lock:
+            if self.killed:
+                raise RuntimeError("Terminated")
+
         txt = "Optimization step %d, simulation %d" % (self.cur_step + 1,
                                                        self.cur_itr + 1)
         self._updatewaitsimwin(txt)
         print(txt)
 
-        # Prepare a dict of parameters for this simulation to populate in GUI
-        opt_params = {}
-        for param_name, param_value in zip(self.step_ranges.keys(),
-                                           new_params):
-            if param_value >= self.step_ranges[param_name]['minval'] and \
-                    param_value <= self.step_ranges[param_name]['maxval']:
-                opt_params[param_name] = param_value
-            else:
-                # This test is not strictly necessary with COBYLA, but in
-                # case the algorithm is changed at some point in the future
+        # This test is not strictly necessary with BOBYQA or COBYLA, but in
+        # case the algorithm is changed at some point in the future
+        new_params = np.asarray(new_params)
+        out_of_range = (new_params < self.opt_lb) | (new_params > self.opt_ub)
+        if np.any(out_of_range):
+            for idx in np.flatnonzero(out_of_range):
                 print('INFO: optimization chose '
                       '%.3f for %s outside of [%.3f-%.3f].'
-                      % (param_value, param_name,
-                         self.step_ranges[param_name]['minval'],
-                         self.step_ranges[param_name]['maxval']))
-                return sys.float_info.max  # return the worst fit ever
+                      % (new_params[idx], self.opt_param_names[idx],
+                         self.opt_lb[idx], self.opt_ub[idx]))
+            return sys.float_info.max  # return the worst fit ever
+
+        # skip the simulation if these parameters were already simulated
+        cache_key = self._get_cache_key(new_params.tolist())
+        if cache_key in self.werr_cache:
+            werr = self.werr_cache[cache_key]
+            txt = "Parameters already simulated: Weighted RMSE = %f" % werr
+            print(txt)
+            self._updatewaitsimwin(txt)
+            self.cur_itr += 1
+            return werr
+
+        # Prepare a dict of parameters for this simulation to populate in GUI
+        opt_params = dict(zip(self.opt_param_names, new_params.tolist()))
 
         # populate param values into GUI
         self.baseparamwin.update_gui_params(opt_params)
@@ -638,30 +862,58 @@ class OptThread(SimThread):
             sim_params[param_name] = param_value
 
         # run the simulation, but stop at self.opt_end
-        self.sim_thread = SimThread(self.ncore, sim_params,
-                                    self.result_callback,
-                                    mainwin=self.mainwin)
-
         self.sim_running = True
-        # may not need to run the entire simulation
-        self.sim_thread.run(sim_length=self.opt_end)
-        self.sim_thread.wait()
+        if cache_key in self.presim_results:
+            # simulated ahead of time by self._presimulate_first_points
+            sim_data = self.presim_results.pop(cache_key)
+            self.result_signal.sig.emit(ResultObj(sim_data, sim_params))
+        else:
+            while True:
+                try:
+                    sim_log = self._log_sim_status(parent=self)
+                    with redirect_stdout(sim_log):
+                        # may not need to run the entire simulation
+                        sim_data = self.mpi_sim.run(sim_params,
+                                                    tstop=self.opt_end)
+                    break
+                except RuntimeError as e:
+                    with self.killed_lock:
+                        if self.killed:
+                            raise RuntimeError("Terminated")
+                        if self.mpi_sim.ncore == 1:
+                            # can't reduce ncore any more
+                            print(str(e))
+                            self._updatewaitsimwin(str(e))
+                            raise RuntimeError("Simulation failed to start")
+
+                        # a smaller number of MPI ranks is unlikely to fix
+                        # the failure, so keep using a single core for
+                        # this and the remaining simulations
+                        self.mpi_sim.use_single_core()
+
+                txt = "INFO: Failed starting simulation, retrying with 1 core"
+                print(txt)
+                self._updatewaitsimwin(txt)
+            self.result_signal.sig.emit(ResultObj(sim_data, sim_params))
         with self.killed_lock:
             if self.killed:
                 self.quit()
         self.sim_running = False
 
         # calculate wRMSE for all steps
-        err_queue = Queue()
-        self.get_werr_from_sim_data.qsig.emit(err_queue, self.paramfn,
+        self.get_werr_from_sim_data.qsig.emit(self.err_queue, self.paramfn,
                                               self.opt_weights, self.opt_end,
                                               self.opt_start)
-        werr = err_queue.get()
+        werr = self.err_queue.get()
+
+        self.werr_cache[cache_key] = werr
+        if len(self.werr_cache) > _werr_cache_size:
+            self.werr_cache.popitem(last=False)
 
         txt = "Weighted RMSE = %f" % werr
         print(txt)
-        self._updatewaitsimwin(os.linesep + 'Simulation finished: ' + txt +
-                               os.linesep)
+        # status lines for this simulation are sent to the GUI together
+        msgs = [os.linesep + 'Simulation finished: ' + txt + os.linesep]
 
         # save params numbered by cur_itr
         # data_dir = op.join(get_output_dir(), 'data')
@@ -671,12 +923,11 @@ class OptThread(SimThread):
         # write_legacy_paramf(param_out, self.params)
 
         if werr < self.best_step_werr:
-            self._updatewaitsimwin("new best with RMSE %f" % werr)
+            msgs.append("new best with RMSE %f" % werr)
 
-            update_event = Event()
-            self.update_opt_data_from_sim_data.esig.emit(update_event,
-                                                         self.paramfn)
-            update_event.wait()
+            # sim_data[paramfn] holds this simulation since the weighted
+            # RMSE above was computed from it
+            self.sim_data.update_opt_data_from_sim_data(self.paramfn)
 
             self.best_step_werr = werr
             # save best param file
@@ -684,21 +935,200 @@ class OptThread(SimThread):
             #                          self.cur_step)
             # write_legacy_paramf(param_out, self.params)
 
+        self._updatewaitsimwin(''.join(msgs))
+
         if self.cur_itr == 0 and self.cur_step > 0:
-            # Update plots for the first simulation only of this step
-            # (best results from last round). Skip the first step because
-            # there are no optimization results to show yet.
+            # Update plots for the first simulation only of this step. This
+            # is not necessarily the best result from the last round, since
+            # BOBYQA moves initial values near a bound before starting. Skip
+            # the first step because there are no optimization results to
+            # show yet.
             self.refresh_signal.sig.emit()  # redraw with updated RMSE
 
         self.cur_itr += 1
 
         return werr
 
+    def _get_cache_key(self, param_values):
+        """Key for werr_cache and presim_results in the current step"""
+        return (self.cur_step, tuple(round(val, 10) for val in param_values))
+
+    def _get_first_points(self, initial, initial_step, algorithm):
+        """Get the first parameter sets nlopt will evaluate
+
+        Returns an empty list for algorithms other than BOBYQA and COBYLA.
+
+        This copies NLopt internals (the initial design of BOBYQA and
+        COBYLA, including how the initial parameters are moved away from
+        bounds and how steps are reversed or doubled there), which are not
+        part of its API. The points are only used if they match the
+        evaluated ones exactly, after rounding by self._get_cache_key. If
+        an nlopt upgrade changes them, every step silently wastes a pool of
+        full simulations. hnn/tests/test_opt_points.py guards against this.
+
+        Parameters
+        ----------
+        initial : list of float
+            Initial values of the parameters optimized in this step
+        initial_step : list of float
+            Initial step size of each parameter used by nlopt
+        algorithm : int
+            The nlopt algorithm
+
+        Returns
+        -------
+        points : list of list of float
+            Parameter sets in the order they will be evaluated
+        """
+        lb, ub = self.opt_lb, self.opt_ub
+        initial_step = np.asarray(initial_step, dtype=float)
+
+        if algorithm == nlopt.LN_COBYLA:
+            # COBYLA evaluates the initial parameters and then moves by
+            # initial_step along each parameter in turn. If an earlier point
+            # improves the fit, COBYLA moves from there instead and the
+            # later points are not used.
+            points = [list(initial)]
+            for idx, step in enumerate(initial_step):
+                point = list(initial)
+                point[idx] += step
+                if point[idx] > ub[idx]:
+                    # COBYLA steps the other way to stay within bounds
+                    point[idx] = initial[idx] - step
+                points.append(point)
+            return points
+
+        if algorithm != nlopt.LN_BOBYQA:
+            return []
+
+        # BOBYQA first moves the initial parameters to a bound or at least
+        # initial_step away from it
+        x0 = np.asarray(initial, dtype=float).copy()
+        near_lb = x0 - lb <= initial_step
+        x0[near_lb] = np.where(x0[near_lb] <= lb[near_lb], lb[near_lb],
+                               lb[near_lb] + initial_step[near_lb])
+        near_ub = ub - x0 <= initial_step
+        x0[near_ub] = np.where(x0[near_ub] >= ub[near_ub], ub[near_ub],
+                               ub[near_ub] - initial_step[near_ub])
+
+        # it then evaluates x0 and a step forward and backward along each
+        # parameter, regardless of the resulting fits. Steps are reversed
+        # or doubled for parameters sitting on a bound.
+        forward = np.where(x0 >= ub, -initial_step, initial_step)
+        backward = np.where(x0 <= lb, 2 * initial_step,
+                            np.where(x0 >= ub, -2 * initial_step,
+                                     -initial_step))
+        points = [x0.tolist()]
+        for steps in (forward, backward):
+            for idx, step in enumerate(steps):
+                point = x0.copy()
+                point[idx] += step
+                points.append(point.tolist())
+        return points
+
+    def _terminate_presim_workers(self):
+        """Terminate the workers that reported their pid since last call"""
+        if self.presim_worker_pids is None:
+            return
+        while not self.presim_worker_pids.empty():
+            _terminate_presimulate(self.presim_worker_pids.get())
+
+    def _presimulate_first_points(self, initial, initial_step, algorithm,
+                                  num_sims):
+        """Simulate the first points nlopt will evaluate in parallel
+
+        These simulations don't depend on each other, so they are run at the
+        same time, splitting the cores of self.mpi_sim between them. Results
+        that end up not being requested by nlopt are simply not used.
+
+        Parameters
+        ----------
+        initial : list of float
+            Initial values of the parameters optimized in this step
+        initial_step : list of float
+            Initial step size of each parameter used by nlopt
+        algorithm : int
+            The nlopt algorithm
+        num_sims : int
+            Maximum number of simulations in this step
+        """
+        self.presim_results = {}
+
+        points = self._get_first_points(initial, initial_step,
+                                        algorithm)[:num_sims]
+        # self.mpi_sim.ncore is limited to the physical cores
+        n_workers = min(len(points), self.mpi_sim.ncore)
+        if n_workers < 2:
+            return
+
+        txt = "Running first %d simulations of step %d in parallel" % \
+            (len(points), self.cur_step + 1)
+        self._updatewaitsimwin(txt)
+        print(txt)
+
+        # use new processes so that NEURON and hnn-core state isn't shared
+        mp_context = multiprocessing.get_context('spawn')
+        worker_pids = mp_context.SimpleQueue()
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=mp_context,
+                                 initializer=_init_presimulate,
+                                 initargs=(worker_pids,)) as executor:
+            with self.killed_lock:
+                if self.killed:
+                    raise RuntimeError("Terminated")
+                # self.stop() terminates the simulations from here on
+                self.presim_worker_pids = worker_pids
+
+            # only submit as many simulations as there are workers, so that
+            # none are waiting in the pool when its workers are terminated
+            remaining = list(points)
+            futures = {}
+            pending = set()
+            while remaining or pending:
+                with self.killed_lock:
+                    if self.killed:
+                        # the pool breaks once all of its workers are
+                        # terminated, including those started after
+                        # self.stop()
+                        remaining = []
+                        self._terminate_presim_workers()
+                    while remaining and len(pending) < n_workers:
+                        point = remaining.pop(0)
+                        sim_params = self.params.copy()
+                        sim_params.update(zip(self.opt_param_names, point))
+                        future = executor.submit(
+                            _presimulate, sim_params,
+                            self.mpi_sim.ncore // n_workers, self.opt_end)
+                        futures[future] = self._get_cache_key(point)
+                        pending.add(future)
+                    self.presim_futures = list(pending)
+
+                # poll to check whether self.stop() was called
+                done, pending = wait(pending, timeout=1,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        self.presim_results[futures[future]] = \
+                            future.result()
+                    except Exception as e:
+                        # also catches a broken or cancelled pool. _opt_sim
+                        # will run this simulation again
+                        print('INFO: parallel simulation failed: %s' %
+                              str(e))
+
+        with self.killed_lock:
+            self.presim_futures = []
+            self.presim_worker_pids = None
+            if self.killed:
+                self.presim_results = {}
+                raise RuntimeError("Terminated")
+
     def _run_opt_step(self, params_input, num_sims, algorithm):
         """Core function for starting the nlopt optimization routine"""
         opt_params = []
         lb = []
         ub = []
+        self.opt_param_names = []
 
         for param_name in params_input.keys():
             upper = params_input[param_name]['maxval']
@@ -709,6 +1139,11 @@ class OptThread(SimThread):
             ub.append(upper)
             lb.append(lower)
             opt_params.append(params_input[param_name]['initial'])
+            self.opt_param_names.append(param_name)
+
+        # bounds are checked as arrays by self._opt_sim
+        self.opt_lb = np.asarray(lb)
+        self.opt_ub = np.asarray(ub)
 
         if algorithm == nlopt.G_MLSL_LDS or algorithm == nlopt.G_MLSL:
             # In case these mixed mode (global + local) algorithms are
@@ -718,10 +1153,19 @@ class OptThread(SimThread):
 
         self.opt.set_lower_bounds(lb)
         self.opt.set_upper_bounds(ub)
+        # trust region radius to start from
+        self.opt.set_initial_step((self.opt_ub - self.opt_lb) * 0.1)
+
+        self._presimulate_first_points(
+            opt_params, self.opt.get_initial_step(opt_params), algorithm,
+            num_sims)
 
         # minimize the wRMSE returned by self._opt_sim
         self.opt.set_min_objective(self._opt_sim)
         self.opt.set_xtol_rel(1e-4)
+        # stop once the fit improves by less than this fraction, since
+        # smaller changes in RMSE are not meaningful
+        self.opt.set_ftol_rel(_opt_ftol_rel)
         self.opt.set_maxeval(num_sims)
 
         # start the optimization: run self.runsim for # iterations in num_sims
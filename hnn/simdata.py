@@ -5,8 +5,8 @@ from math import ceil
 from glob import glob
 from pickle import dump, load
 from copy import deepcopy
+from threading import Lock
 
-from scipy import signal
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -235,6 +235,10 @@ class SimData(object):
         self._opt_data = {'initial_dpl': None,
                           'initial_error': sys.float_info.max}
         self._exp_data = {}
+        # calcerr may be called from the optimization thread
+        self._exp_data_lock = Lock()
+        # opt_data is updated from the optimization thread
+        self._opt_data_lock = Lock()
         self._data_dir = os.path.join(get_output_dir(), 'data')
 
     def remove_sim_by_fn(self, paramfn):
@@ -259,7 +263,8 @@ class SimData(object):
     def clear_exp_data(self):
         """Clear all experimental data from SimData"""
 
-        self._exp_data = {}
+        with self._exp_data_lock:
+            self._exp_data = {}
 
     def clear_sim_data(self):
         """Clear all simulation data from SimData"""
@@ -276,7 +281,8 @@ class SimData(object):
         exp_data : array
             Data from np.loadtxt() on experimental data file
         """
-        self._exp_data[exp_fn] = exp_data
+        with self._exp_data_lock:
+            self._exp_data[exp_fn] = exp_data
 
     def get_exp_data_size(self):
         """Adds experimental data to SimData
@@ -391,10 +397,14 @@ class SimData(object):
         errtot : float
             Average RMSE over all experimental data files
         """
+        from scipy import signal
 
         NSig = errtot = 0.0
         lerr = []
-        for _, dat in self._exp_data.items():
+        with self._exp_data_lock:
+            exp_data = list(self._exp_data.values())
+
+        for dat in exp_data:
             shp = dat.shape
 
             exp_times = dat[:, 0]
@@ -417,31 +427,39 @@ class SimData(object):
             sim_end_index = (np.abs(sim_times - tstop)).argmin()
             sim_length = sim_end_index - sim_start_index
 
+            # the simulated dipole and weights are the same for every
+            # column of the experimental data, so only prepare them once
+            sim_dpl = self._sim_data[paramfn]['data']['avg_dpl']
+            dpl1 = sim_dpl.data['agg'][sim_start_index:sim_end_index]
+            weight = None
             if weights is not None:
                 weight = weights[sim_start_index:sim_end_index]
 
+            if (sim_length > exp_length):
+                # downsample simulation timeseries to match exp data
+                dpl1 = signal.resample(dpl1, exp_length)
+                if weight is not None:
+                    weight = signal.resample(weight, exp_length)
+                    weight[weight < 1e-4] = 0
+
+            if weight is not None:
+                weight_sum = weight.sum()
+
             for c in range(1, shp[1], 1):
-                sim_dpl = self._sim_data[paramfn]['data']['avg_dpl']
-                dpl1 = sim_dpl.data['agg'][sim_start_index:sim_end_index]
                 dpl2 = dat[exp_start_index:exp_end_index, c]
 
-                if (sim_length > exp_length):
-                    # downsample simulation timeseries to match exp data
-                    dpl1 = signal.resample(dpl1, exp_length)
-                    if weights is not None:
-                        weight = signal.resample(weight, exp_length)
-                        indices = np.where(weight < 1e-4)
-                        weight[indices] = 0
-
-                elif (sim_length < exp_length):
+                if (sim_length < exp_length):
                     # downsample exp timeseries to match simulation data
                     dpl2 = signal.resample(dpl2, sim_length)
 
-                if weights is not None:
-                    err0 = np.sqrt((weight * ((dpl1 - dpl2) ** 2)).sum() /
-                                   weight.sum())
+                # sum the (weighted) squared error without allocating an
+                # array for it
+                diff = dpl1 - dpl2
+                if weight is not None:
+                    err0 = np.sqrt(np.einsum('i,i,i', weight, diff, diff) /
+                                   weight_sum)
                 else:
-                    err0 = np.sqrt(((dpl1 - dpl2) ** 2).mean())
+                    err0 = np.sqrt(np.dot(diff, diff) / len(diff))
                 lerr.append(err0)
                 errtot += err0
                 NSig += 1
@@ -451,8 +469,9 @@ class SimData(object):
         return lerr, errtot
 
     def clear_opt_data(self):
-        self._opt_data = {'initial_dpl': None,
-                          'initial_error': sys.float_info.max}
+        with self._opt_data_lock:
+            self._opt_data = {'initial_dpl': None,
+                              'initial_error': sys.float_info.max}
 
     def in_sim_data(self, paramfn):
         if paramfn in self._sim_data:
@@ -462,27 +481,29 @@ class SimData(object):
     def update_opt_data(self, paramfn, params, avg_dpl, dpls=None,
                         spikes=None, gid_ranges=None, spec=None,
                         vsoma=None):
-        self._opt_data = {'initial_dpl': self._opt_data['initial_dpl'],
-                          'initial_error': self._opt_data['initial_error'],
-                          'paramfn': paramfn,
-                          'params': params,
-                          'data': {'dpls': None,
-                                   'avg_dpl': avg_dpl,
-                                   'spikes': None,
-                                   'gid_ranges': None,
-                                   'spec': None,
-                                   'vsoma': None}}
-
-    def update_initial_opt_data_from_sim_data(self, event, paramfn):
+        with self._opt_data_lock:
+            self._opt_data = {
+                'initial_dpl': self._opt_data['initial_dpl'],
+                'initial_error': self._opt_data['initial_error'],
+                'paramfn': paramfn,
+                'params': params,
+                'data': {'dpls': None,
+                         'avg_dpl': avg_dpl,
+                         'spikes': None,
+                         'gid_ranges': None,
+                         'spec': None,
+                         'vsoma': None}}
+
+    def update_initial_opt_data_from_sim_data(self, paramfn):
         if paramfn not in self._sim_data:
             raise ValueError("Simulation not in sim_data: %s" % paramfn)
 
         single_sim_data = self._sim_data[paramfn]['data']
-        self._opt_data['initial_dpl'] = \
-            deepcopy(single_sim_data['avg_dpl'])
-        self._opt_data['initial_error'] = self.get_err(paramfn)
-
-        event.set()
+        initial_dpl = deepcopy(single_sim_data['avg_dpl'])
+        initial_error = self.get_err(paramfn)
+        with self._opt_data_lock:
+            self._opt_data['initial_dpl'] = initial_dpl
+            self._opt_data['initial_error'] = initial_error
 
     def get_err(self, paramfn, tstop=None):
         if paramfn not in self._sim_data:
@@ -493,10 +514,6 @@ class SimData(object):
         _,  err = self.calcerr(paramfn, tstop)
         return err
 
-    def get_err_wrapper(self, queue, paramfn, tstop=None):
-        err = self.get_err(paramfn, tstop)
-        queue.put(err)
-
     def get_werr(self, paramfn, weights, tstop=None, tstart=None):
         if paramfn not in self._sim_data:
             raise ValueError("Simulation not in sim_data: %s" % paramfn)
@@ -511,41 +528,33 @@ class SimData(object):
         err = self.get_werr(paramfn, weights, tstop, tstart)
         queue.put(err)
 
-    def update_opt_data_from_sim_data(self, event, paramfn):
+    def update_opt_data_from_sim_data(self, paramfn):
         if paramfn not in self._sim_data:
             raise ValueError("Simulation not in sim_data: %s" % paramfn)
 
+        # Every simulation stores newly created data objects in
+        # sim_data[paramfn] (see update_sim_data), and the data are not
+        # modified afterwards. References can be shared instead of
+        # copying dipoles and spikes each time a new best is found.
         sim_params = self._sim_data[paramfn]['params']
         single_sim = self._sim_data[paramfn]['data']
-        self._opt_data = {'initial_dpl': self._opt_data['initial_dpl'],
-                          'initial_error': self._opt_data['initial_error'],
-                          'paramfn': paramfn,
-                          'params': deepcopy(sim_params),
-                          'data': {'dpls': deepcopy(single_sim['dpls']),
-                                   'avg_dpl': deepcopy(single_sim['avg_dpl']),
-                                   'spikes': deepcopy(single_sim['spikes']),
-                                   'gid_ranges':
-                                       deepcopy(single_sim['gid_ranges']),
-                                   'spec': deepcopy(single_sim['spec']),
-                                   'vsoma': deepcopy(single_sim['vsoma'])}}
-
-        event.set()
-
-    def update_sim_data_from_opt_data(self, event, paramfn):
-        opt_data = self._opt_data['data']
-        single_sim = {'paramfn': paramfn,
-                      'params': deepcopy(self._opt_data['params']),
-                      'data': {'dpls': deepcopy(opt_data['dpls']),
-                               'avg_dpl': deepcopy(opt_data['avg_dpl']),
-                               'spikes': deepcopy(opt_data['spikes']),
-                               'gid_ranges':
-                                   deepcopy(opt_data['gid_ranges']),
-                               'spec': deepcopy(opt_data['spec']),
-                               'vsoma': deepcopy(opt_data['vsoma'])}}
+        with self._opt_data_lock:
+            self._opt_data = {
+                'initial_dpl': self._opt_data['initial_dpl'],
+                'initial_error': self._opt_data['initial_error'],
+                'paramfn': paramfn,
+                'params': deepcopy(sim_params),
+                'data': dict(single_sim)}
+
+    def update_sim_data_from_opt_data(self, paramfn):
+        # data objects are shared with opt_data, see
+        # update_opt_data_from_sim_data
+        with self._opt_data_lock:
+            single_sim = {'paramfn': paramfn,
+                          'params': deepcopy(self._opt_data['params']),
+                          'data': dict(self._opt_data['data'])}
         self._sim_data[paramfn] = single_sim
 
-        event.set()
-
     def _read_dpl(self, paramfn, trial_idx, ntrial):
         if ntrial == 1:
             dpltrial = self._sim_data[paramfn]['data']['avg_dpl']
@@ -725,6 +734,9 @@ class SimData(object):
             True if plots should be specific for optimization results
         """
 
+        with self._opt_data_lock:
+            opt_data = dict(self._opt_data)
+
         yl = [0, 0]
         dpl = self._sim_data[paramfn]['data']['avg_dpl']
         yl[0] = min(yl[0], np.amin(dpl.data['agg']))
@@ -754,9 +766,9 @@ class SimData(object):
                         linewidth=linewidth + 1)
                 yl[0] = min(yl[0], dpl.data['agg'].min())
                 yl[1] = max(yl[1], dpl.data['agg'].max())
-        elif 'data' in self._opt_data:
-            if 'avg_dpl' not in self._opt_data['data'] or \
-                    'initial_dpl' not in self._opt_data:
+        elif 'data' in opt_data:
+            if 'avg_dpl' not in opt_data['data'] or \
+                    'initial_dpl' not in opt_data:
                 # if there was an exception running optimization
                 # still plot average dipole from sim
                 ax.plot(dpl.times, dpl.data['agg'], 'k',
@@ -764,22 +776,22 @@ class SimData(object):
                 yl[0] = min(yl[0], dpl.data['agg'].min())
                 yl[1] = max(yl[1], dpl.data['agg'].max())
             else:
-                if self._opt_data['data']['avg_dpl'] is not None:
+                if opt_data['data']['avg_dpl'] is not None:
                     # show optimized dipole as gray line
-                    optdpl = self._opt_data['data']['avg_dpl']
+                    optdpl = opt_data['data']['avg_dpl']
                     ax.plot(optdpl.times, optdpl.data['agg'], 'k',
                             color='gray', linewidth=linewidth + 1)
                     yl[0] = min(yl[0], optdpl.data['agg'].min())
                     yl[1] = max(yl[1], optdpl.data['agg'].max())
 
-                if self._opt_data['initial_dpl'] is not None:
+                if opt_data['initial_dpl'] is not None:
                     # show initial dipole in dotted black line
-                    plot_data = self._opt_data['initial_dpl']
+                    plot_data = opt_data['initial_dpl']
                     times = plot_data.times
                     plot_dpl = plot_data.data['agg']
                     ax.plot(times, plot_dpl, '--', color='black',
                             linewidth=linewidth)
-                    dpl = self._opt_data['initial_dpl'].data['agg']
+                    dpl = opt_data['initial_dpl'].data['agg']
                     yl[0] = min(yl[0], dpl.min())
                     yl[1] = max(yl[1], dpl.max())
 
@@ -8,7 +8,6 @@
 # hnn-core integration
 
 import numpy as np
-import scipy.signal as sps
 from copy import deepcopy
 import matplotlib.pyplot as plt
 
@@ -62,6 +61,8 @@ class MorletSpec():
 
     # also creates self.timevec
     def __traces2TFR(self):
+        import scipy.signal as sps
+
         self.S_trans = self.tsvec.transpose()
         # self.S_trans = self.S.transpose()
 
@@ -122,6 +123,8 @@ class MorletSpec():
             f: frequency
             s: signal
         """
+        import scipy.signal as sps
+
         dt = 1. / self.fs
         sf = f / self.width
         st = 1. / (2. * np.pi * sf)
@@ -147,6 +150,8 @@ class MorletSpec():
 # core class for frequency analysis assuming stationary time series
 class Welch():
     def __init__(self, t_vec, ts_vec, dt):
+        import scipy.signal as sps
+
         # assign data internally
         self.t_vec = t_vec
         self.ts_vec = ts_vec
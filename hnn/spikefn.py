@@ -37,6 +37,20 @@ def _hist_bin_opt(x, N_trials):
     return bin_opt
 
 
+def _get_range_bounds(gids):
+    """Get the bounds of the contiguous ranges of gids
+
+    Returns the sorted array [start_0, stop_0, start_1, stop_1, ...]. A gid
+    is in one of the ranges if np.searchsorted(bounds, gid, side='right') is
+    odd.
+    """
+    gids = np.unique(gids)
+    breaks = np.flatnonzero(np.diff(gids) != 1) + 1
+    starts = gids[np.r_[0, breaks]]
+    stops = gids[np.r_[breaks - 1, len(gids) - 1]] + 1
+    return np.column_stack((starts, stops)).ravel()
+
+
 class ExtInputs(object):
     """Class for extracting gids and times from external inputs"""
 
@@ -131,6 +145,7 @@ class ExtInputs(object):
                     gid_prox += list(self.gid_ranges['evprox' + str(i + 1)])
             gid_prox = np.array(gid_prox)
             self.evprox_gid_range = (min(gid_prox), max(gid_prox))
+            self.evprox_gid_bounds = _get_range_bounds(gid_prox)
         if ndist > 0:
             gid_dist = []
             for i in range(ndist):
@@ -138,78 +153,102 @@ class ExtInputs(object):
                     gid_dist += list(self.gid_ranges['evdist' + str(i + 1)])
             gid_dist = np.array(gid_dist)
             self.evdist_gid_range = (min(gid_dist), max(gid_dist))
+            self.evdist_gid_bounds = _get_range_bounds(gid_dist)
 
         return gid_prox, gid_dist
 
-    def _filter(self, spikes, trials, filter_range):
-        """returns spike_list, a list of lists of spikes.
+    def _filter(self, spikes, trials, filter_ranges):
+        """Get the spike times of each gid range in filter_ranges
 
-        Each list corresponds to a cell, counted by range
+        Spikes of all trials are sorted into the ranges in a single pass,
+        so the ranges must not overlap. Returns a list with the array of
+        spike times of each range.
         """
 
-        filtered_spike_times = []
+        # fill single preallocated arrays with the spikes of each trial
+        n_spikes = sum(len(spikes.spike_gids[trial_idx])
+                       for trial_idx in trials)
+        spike_times = np.empty(n_spikes)
+        spike_gids = np.empty(n_spikes, dtype=int)
+        start = 0
         for trial_idx in trials:
-            indices = np.where(np.in1d(spikes.spike_gids[trial_idx],
-                                       filter_range))[0]
-            matches = np.array(spikes.spike_times[trial_idx])[indices]
-            filtered_spike_times += list(matches)
-
-        return np.array(filtered_spike_times)
-
-    def _get_times(self, spikes, trials, filter_range):
-        return self._filter(spikes, trials, filter_range)
-
-    def _unique_times(self, spikes, trials, filter_range):
-        filtered_spike_times = self._get_times(spikes, trials, filter_range)
-
-        return np.unique(filtered_spike_times)
+            n_trial_spikes = len(spikes.spike_gids[trial_idx])
+            end = start + n_trial_spikes
+            spike_times[start:end] = spikes.spike_times[trial_idx]
+            spike_gids[start:end] = spikes.spike_gids[trial_idx]
+            start = end
+
+        # position in filter_ranges of the range containing each gid
+        range_lut = np.full(spike_gids.max() + 1 if n_spikes else 0, -1)
+        for range_idx, filter_range in enumerate(filter_ranges):
+            filter_range = np.asarray(filter_range, dtype=int)
+            range_lut[filter_range[filter_range < len(range_lut)]] = \
+                range_idx
+        spike_ranges = range_lut[spike_gids]
+
+        return [spike_times[spike_ranges == range_idx]
+                for range_idx in range(len(filter_ranges))]
 
     def _get_extinput_times(self, spikes, trials):
         """load all spike times from file"""
 
         inputs = {k: np.array([]) for k in ['prox', 'dist', 'evprox', 'evdist',
                                             'pois']}
+        input_gids = {'prox': None, 'dist': None, 'evprox': self.gid_evprox,
+                      'evdist': self.gid_evdist, 'pois': self.gid_pois}
         if self.gid_prox is not None:
-            inputs['prox'] = self._get_times(spikes, trials, [self.gid_prox])
+            input_gids['prox'] = [self.gid_prox]
         if self.gid_dist is not None:
-            inputs['dist'] = self._get_times(spikes, trials, [self.gid_dist])
-        if self.gid_evprox is not None:
-            inputs['evprox'] = self._unique_times(spikes, trials,
-                                                  self.gid_evprox)
-        if self.gid_evdist is not None:
-            inputs['evdist'] = self._unique_times(spikes, trials,
-                                                  self.gid_evdist)
-        if self.gid_pois is not None:
-            inputs['pois'] = self._unique_times(spikes, trials, self.gid_pois)
+            input_gids['dist'] = [self.gid_dist]
+
+        input_keys = [key for key in input_gids
+                      if input_gids[key] is not None]
+        input_times = self._filter(spikes, trials,
+                                   [input_gids[key] for key in input_keys])
+        for key, times in zip(input_keys, input_times):
+            if key in ('prox', 'dist'):
+                inputs[key] = times
+            else:
+                inputs[key] = np.unique(times)
 
         return inputs
 
     def is_prox_gid(self, gid):
-        """check if gid is associated with a proximal input"""
+        """check if gid is associated with a proximal input
 
-        if gid == self.gid_prox:
-            return True
+        gid can also be an array of gids
+        """
+
+        is_prox = gid == self.gid_prox
         if len(self.inputs['evprox']) > 0:
-            return self.evprox_gid_range[0] <= gid <= self.evprox_gid_range[1]
+            is_prox |= np.searchsorted(self.evprox_gid_bounds, gid,
+                                       side='right') % 2 == 1
 
-        return False
+        return is_prox
 
     def is_dist_gid(self, gid):
-        """check if gid is associated with a distal input"""
+        """check if gid is associated with a distal input
+
+        gid can also be an array of gids
+        """
 
-        if gid == self.gid_dist:
-            return True
+        is_dist = gid == self.gid_dist
         if len(self.inputs['evdist']) > 0:
-            return self.evdist_gid_range[0] <= gid <= self.evdist_gid_range[1]
+            is_dist |= np.searchsorted(self.evdist_gid_bounds, gid,
+                                       side='right') % 2 == 1
 
-        return False
+        return is_dist
 
     def is_pois_gid(self, gid):
-        """check if gid is associated with a Poisson input"""
+        """check if gid is associated with a Poisson input
+
+        gid can also be an array of gids
+        """
         if len(self.inputs['pois']) > 0:
-            return self.pois_gid_range[0] <= gid <= self.pois_gid_range[1]
+            return (self.pois_gid_range[0] <= gid) & \
+                (gid <= self.pois_gid_range[1])
 
-        return False
+        return np.zeros_like(gid, dtype=bool)
 
     def _add_delay_times(self):
         # if same prox delay to both layers, add it to the prox input times
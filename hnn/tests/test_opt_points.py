@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import numpy as np
+from numpy.testing import assert_allclose
+import nlopt
+import pytest
+
+from hnn.qt_thread import OptThread
+
+
+@pytest.mark.parametrize('algorithm', [nlopt.LN_BOBYQA, nlopt.LN_COBYLA])
+@pytest.mark.parametrize('initial', [[0.5, 2.0, 1e-3],  # inside bounds
+                                     [0.0, 4.0, 2e-3],  # on bounds
+                                     [0.1, 3.9, 1.1e-3]])  # near bounds
+def test_get_first_points(algorithm, initial):
+    """Predicted first parameter sets match those evaluated by nlopt"""
+    lb = np.array([0.0, 0.0, 1e-3])
+    ub = np.array([2.0, 4.0, 2e-3])
+    n_params = len(initial)
+
+    evaluated = []
+
+    def objective(x, grad):
+        evaluated.append(x.tolist())
+        # every other point has a worse fit than the initial parameters
+        return float(np.sum((x - initial) ** 2))
+
+    opt = nlopt.opt(algorithm, n_params)
+    opt.set_lower_bounds(lb)
+    opt.set_upper_bounds(ub)
+    opt.set_initial_step((ub - lb) * 0.1)
+    opt.set_min_objective(objective)
+    opt.set_maxeval(2 * n_params + 1)
+    opt.optimize(initial)
+
+    # _get_first_points only uses the bounds of the current step
+    opt_thread = SimpleNamespace(opt_lb=lb, opt_ub=ub)
+    points = OptThread._get_first_points(opt_thread, initial,
+                                         opt.get_initial_step(initial),
+                                         algorithm)
+
+    n_points = 2 * n_params + 1 if algorithm == nlopt.LN_BOBYQA \
+        else n_params + 1
+    assert len(points) == n_points
+    assert_allclose(points, evaluated[:n_points], rtol=1e-10)
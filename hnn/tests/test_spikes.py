@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+from matplotlib.colors import to_rgb
+
+from hnn.qt_spike import get_hist_bins, getdspk
+from hnn.spikefn import ExtInputs
+
+
+def _make_inputs():
+    """Spikes of two trials for every cell type and input, with params"""
+    gid_ranges = {'L2_basket': range(0, 3),
+                  'L2_pyramidal': range(3, 7),
+                  'L5_basket': range(7, 9),
+                  'L5_pyramidal': range(9, 13),
+                  'common': range(13, 15),  # prox, then dist
+                  'evprox1': range(15, 17),
+                  'evdist1': range(17, 19),
+                  # evdist1 sits between the evprox ranges
+                  'evprox2': range(19, 21),
+                  'extpois': range(21, 23)}
+    spikes = SimpleNamespace(
+        spike_times=[[0.0, 2.0, 5.0, 4.0, 20.0, 6.0, 7.5, 7.0, 12.0, 8.0,
+                      9.0],
+                     [19.9, 3.0, 6.0, 25.0, 11.0]],
+        spike_gids=[[3, 13, 3, 14, 9, 15, 0, 19, 7, 17, 21],
+                    [12, 13, 16, 4, 22]])
+    params = {'tstop': 20.0, 't0_pois': 0.0,
+              't0_input_prox': 0.0, 't0_input_dist': 0.0,
+              # same proximal delay to both layers is added to the times
+              'input_prox_A_delay_L2': 1.0, 'input_prox_A_delay_L5': 1.0,
+              'input_dist_A_delay_L2': 2.0, 'input_dist_A_delay_L5': 3.0}
+    return spikes, gid_ranges, params
+
+
+def test_extinputs():
+    """Input spike times are sorted by input type"""
+    spikes, gid_ranges, params = _make_inputs()
+    extinputs = ExtInputs(spikes, gid_ranges, [0, 1], params)
+
+    assert extinputs.gid_prox == 13
+    assert extinputs.gid_dist == 14
+    assert_allclose(extinputs.inputs['prox'], [3.0, 4.0])
+    assert_allclose(extinputs.inputs['dist'], [4.0])
+    # evoked and Poisson input times are unique over all trials
+    assert_allclose(extinputs.inputs['evprox'], [6.0, 7.0])
+    assert_allclose(extinputs.inputs['evdist'], [8.0])
+    assert_allclose(extinputs.inputs['pois'], [9.0, 11.0])
+
+
+def test_getdspk():
+    """Spikes of all trials are split into cells and inputs"""
+    spikes, gid_ranges, params = _make_inputs()
+    extinputs = ExtInputs(spikes, gid_ranges, [0, 1], params)
+
+    spike_arr = np.column_stack(
+        (np.concatenate(spikes.spike_times),
+         np.concatenate(spikes.spike_gids).astype(np.float64)))
+    bin_edges, bin_centers = get_hist_bins(params['tstop'])
+    assert_allclose(bin_edges, [0.0, 5.0, 10.0, 15.0, 20.0])
+    assert_allclose(bin_centers, [2.5, 7.5, 12.5, 17.5])
+
+    dspk, haveinputs, dhist = getdspk(spike_arr, extinputs, bin_edges)
+
+    assert haveinputs
+    assert_allclose(dspk['Cell']['times'],
+                    [0.0, 5.0, 20.0, 7.5, 12.0, 19.9, 25.0])
+    assert_array_equal(dspk['Cell']['gids'], [3, 3, 9, 0, 7, 12, 4])
+    assert_allclose(dspk['Cell']['colors'],
+                    [to_rgb(clr) for clr in 'ggrwbrg'])
+
+    assert_allclose(dspk['Input']['times'],
+                    [2.0, 4.0, 6.0, 7.0, 8.0, 9.0, 3.0, 6.0, 11.0])
+    # prox and dist feeds are shown at 0 and 1, evoked inputs at 2 and 3
+    assert_array_equal(dspk['Input']['gids'], [0, 1, 2, 2, 3, 21, 0, 2, 22])
+    assert_allclose(dspk['Input']['colors'],
+                    [to_rgb(clr) for clr in ['r', 'g', 'r', 'r', 'g',
+                                             'orange', 'r', 'r', 'orange']])
+
+    # a spike at a bin edge is in the following bin, except at tstop. Later
+    # spikes are not counted
+    assert_array_equal(dhist['L2_pyramidal'], [1, 1, 0, 0])
+    assert_array_equal(dhist['L5_pyramidal'], [0, 0, 0, 2])
+    assert_array_equal(dhist['L2_basket'], [0, 1, 0, 0])
+    assert_array_equal(dhist['L5_basket'], [0, 0, 1, 0])